@@ -1,19 +1,26 @@
 import os
-import re
+import gc
+import asyncio
 import io
-import base64
 import logging
 import uuid
-import pickle
+import socket
+import weakref
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache
 from typing import Optional
 from PIL import Image
 
-import redis
+import msgpack
+from cachetools import TTLCache
+import pybase64
+import redis.asyncio as aioredis
+import zstandard as zstd
 import google.generativeai as genai
-from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, File, Form, HTTPException, Request, UploadFile
+from fastapi.responses import FileResponse, ORJSONResponse
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 from dotenv import load_dotenv
 
 # --- Configuração do Logging ---
@@ -23,38 +30,273 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 load_dotenv()
 
 # --- Configuração do Cliente Redis ---
+redis_pool = None
 redis_client = None
 try:
     redis_url = os.getenv("REDIS_URL")
     if not redis_url:
         raise ValueError("A variável de ambiente REDIS_URL não foi encontrada.")
-    redis_client = redis.from_url(redis_url, decode_responses=False)
-    redis_client.ping()
-    logging.info("Conexão com o Redis estabelecida com sucesso.")
+    # Pool explícito e persistente, dimensionado para a concorrência de cada worker.
+    # O keepalive evita refazer o handshake TCP a cada pico de requisições.
+    redis_pool = aioredis.ConnectionPool.from_url(
+        redis_url,
+        decode_responses=False,
+        max_connections=int(os.getenv("REDIS_MAX_CONNECTIONS", "64")),
+        socket_keepalive=True,
+        socket_keepalive_options={
+            socket.TCP_KEEPIDLE: 60,
+            socket.TCP_KEEPINTVL: 10,
+            socket.TCP_KEEPCNT: 3,
+        },
+        health_check_interval=30,
+    )
+    # Cliente assíncrono: as chamadas ao Redis não bloqueiam o event loop.
+    redis_client = aioredis.Redis(connection_pool=redis_pool)
 except Exception as e:
-    logging.critical(f"Falha crítica ao conectar com o Redis: {e}")
+    logging.critical(f"Falha crítica ao configurar o cliente Redis: {e}")
 
 # --- Configuração da API do Gemini ---
+MODEL_NAME = "gemini-1.5-flash-latest"
+DEFAULT_LANGUAGE = "Português (Brasil)"
+# Idiomas oferecidos pela interface. O idioma vai para a system instruction, então nunca
+# aceitamos texto livre do cliente nesse campo.
+SUPPORTED_LANGUAGES = (DEFAULT_LANGUAGE, "English", "Español")
+
+@lru_cache(maxsize=len(SUPPORTED_LANGUAGES))
+def get_model(language):
+    """Modelo com o idioma fixado na system instruction, reaproveitado por idioma.
+
+    Assim o idioma não precisa ser repetido no prompt de cada turno da conversa.
+    """
+    return genai.GenerativeModel(model_name=MODEL_NAME, system_instruction=f"Responda sempre em {language}.")
+
 model = None
 try:
     api_key = os.getenv("GEMINI_API_KEY")
     if not api_key:
         raise ValueError("A variável de ambiente GEMINI_API_KEY não foi encontrada.")
     genai.configure(api_key=api_key)
-    model = genai.GenerativeModel(model_name="gemini-1.5-flash-latest")
+    model = get_model(DEFAULT_LANGUAGE)
     logging.info("Modelo Gemini inicializado e pronto para uso.")
 except Exception as e:
     logging.critical(f"Falha crítica ao inicializar a API do Gemini: {e}")
 
 # --- Configuração do FastAPI ---
-app = FastAPI()
+# orjson serializa as respostas bem mais rápido que o json da stdlib.
+app = FastAPI(default_response_class=ORJSONResponse)
+
+@app.on_event("startup")
+async def check_redis_connection():
+    global redis_client
+    if not redis_client:
+        return
+    try:
+        await redis_client.ping()
+        logging.info("Conexão com o Redis estabelecida com sucesso.")
+    except Exception as e:
+        logging.critical(f"Falha crítica ao conectar com o Redis: {e}")
+        redis_client = None
+
+@app.on_event("shutdown")
+async def close_redis_pool():
+    if redis_pool:
+        await redis_pool.disconnect()
+        logging.info("Pool de conexões do Redis encerrado.")
 
 class ChatRequest(BaseModel):
+    model_config = ConfigDict(strict=True, str_max_length=10_000_000, extra="ignore")
+
     text: Optional[str] = ""
     image_base64: Optional[str] = None
-    language: Optional[str] = "Português (Brasil)"
+    language: Optional[str] = None
     session_id: Optional[str] = None
 
+SESSION_EXPIRATION_SECONDS = 1800 # 30 minutos
+DEFAULT_MAX_HISTORY_MESSAGES = 20
+
+def read_max_history_messages():
+    """Lê a janela de histórico por sessão (em mensagens), sempre positiva e par.
+
+    Par para que cada pergunta mantenha sua resposta; ímpares são arredondados para cima.
+    """
+    raw = os.getenv("MAX_HISTORY_MESSAGES", str(DEFAULT_MAX_HISTORY_MESSAGES))
+    try:
+        value = int(raw)
+    except ValueError:
+        value = 0
+    if value <= 0:
+        logging.error(f"MAX_HISTORY_MESSAGES inválido ({raw!r}); usando {DEFAULT_MAX_HISTORY_MESSAGES}.")
+        return DEFAULT_MAX_HISTORY_MESSAGES
+    if value % 2:
+        logging.warning(f"MAX_HISTORY_MESSAGES ímpar ({value}); arredondando para {value + 1}.")
+        value += 1
+    return value
+
+MAX_HISTORY_MESSAGES = read_max_history_messages()
+
+# Cache local (L1) de ChatSession por sessão; o Redis continua sendo a fonte persistente.
+# Desligado por padrão: só é correto quando o balanceador mantém cada sessão sempre no mesmo
+# worker. Sem isso, um worker responderia com um histórico defasado.
+LOCAL_SESSION_CACHE_ENABLED = os.getenv("LOCAL_SESSION_CACHE", "").lower() in ("1", "true", "yes")
+chat_sessions = TTLCache(maxsize=10_000, ttl=SESSION_EXPIRATION_SECONDS)
+# Um lock por sessão, vivo enquanto houver requisição usando-o.
+session_locks = weakref.WeakValueDictionary()
+
+def session_lock(session_id):
+    """Serializa os turnos concorrentes de uma sessão, que compartilham o ChatSession do cache local."""
+    if not LOCAL_SESSION_CACHE_ENABLED or not session_id:
+        return nullcontext()
+    lock = session_locks.get(session_id)
+    if lock is None:
+        lock = session_locks[session_id] = asyncio.Lock()
+    return lock
+
+def session_key(session_id):
+    """Chave da lista Redis que guarda os turnos da sessão, um item serializado por turno."""
+    return f"sess:{session_id}"
+
+def session_language_key(session_id):
+    """Chave com o idioma escolhido para a sessão, num prefixo que não colide com `session_key`."""
+    return f"sess-lang:{session_id}"
+
+def parse_session_id(session_id):
+    """Normaliza o id enviado pelo cliente; só UUIDs (o que o servidor emite) são aceitos.
+
+    Qualquer outro valor vira None, isto é, uma sessão nova: o cliente nunca escolhe a chave no Redis.
+    """
+    if not session_id:
+        return None
+    try:
+        return str(uuid.UUID(session_id))
+    except ValueError:
+        logging.warning("session_id malformado recebido; iniciando nova sessão.")
+        return None
+
+# Janela em que leituras de sessão concorrentes são acumuladas antes de ir ao Redis.
+SESSION_READ_COALESCE_SECONDS = 0.001
+
+class SessionReadCoalescer:
+    """Agrupa as leituras de sessão que chegam juntas num único pipeline ao Redis.
+
+    Sob carga, N requisições simultâneas custam um round-trip em vez de N. Leituras
+    repetidas da mesma sessão dentro da janela compartilham o mesmo resultado.
+    """
+
+    def __init__(self, window=SESSION_READ_COALESCE_SECONDS):
+        self._window = window
+        self._pending = {}
+        self._flush_task = None
+
+    async def fetch(self, session_id):
+        """Devolve `(turnos serializados, idioma)` da sessão e renova o TTL das suas chaves."""
+        future = self._pending.get(session_id)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._pending[session_id] = future
+            if self._flush_task is None:
+                self._flush_task = asyncio.create_task(self._flush())
+                self._flush_task.add_done_callback(self._flush_done)
+        # shield: o cancelamento de um cliente não pode cancelar o resultado dos demais.
+        return await asyncio.shield(future)
+
+    def _flush_done(self, task):
+        # O flush terminou (ou foi cancelado, mesmo antes de começar) sem assumir o lote:
+        # libera o estado para que os próximos fetch() agendem outro, e não deixa ninguém pendurado.
+        if self._flush_task is task:
+            pending, self._pending, self._flush_task = self._pending, {}, None
+            self._cancel_unresolved(pending)
+
+    @staticmethod
+    def _cancel_unresolved(pending):
+        for future in pending.values():
+            if not future.done():
+                future.cancel()
+
+    async def _flush(self):
+        await asyncio.sleep(self._window)
+        pending, self._pending, self._flush_task = self._pending, {}, None
+        try:
+            await self._read(pending)
+        finally:
+            self._cancel_unresolved(pending)
+
+    async def _read(self, pending):
+        session_ids = list(pending)
+        try:
+            # transaction=False basta: não precisamos de atomicidade, e EXPIRE numa chave inexistente não faz nada.
+            # raise_on_error=False: o erro de uma sessão não pode derrubar a leitura das outras.
+            async with redis_client.pipeline(transaction=False) as pipe:
+                for session_id in session_ids:
+                    pipe.lrange(session_key(session_id), 0, -1)
+                    pipe.expire(session_key(session_id), SESSION_EXPIRATION_SECONDS)
+                    pipe.expire(session_language_key(session_id), SESSION_EXPIRATION_SECONDS)
+                pipe.mget([session_language_key(session_id) for session_id in session_ids])
+                results = await pipe.execute(raise_on_error=False)
+        except Exception as e:
+            # Falha do pipeline inteiro (ex.: conexão): aí sim afeta todo o lote.
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+        languages = results[-1]
+        if isinstance(languages, Exception):
+            # O idioma é opcional: sem ele, a sessão segue com o idioma da requisição ou o padrão.
+            logging.warning(f"Falha ao ler o idioma das sessões: {languages}")
+            languages = [None] * len(session_ids)
+        for index, session_id in enumerate(session_ids):
+            future = pending[session_id]
+            if future.done():
+                continue
+            turns = results[3 * index]
+            if isinstance(turns, Exception):
+                future.set_exception(turns)
+            else:
+                future.set_result((turns, languages[index]))
+
+session_reads = SessionReadCoalescer()
+
+def history_to_wire(history):
+    """Converte o histórico do Gemini numa lista simples de dicts serializável."""
+    return [
+        {"role": content.role, "parts": [part.text for part in content.parts]}
+        for content in history
+    ]
+
+def wire_to_history(wire):
+    """Reconstrói o histórico no formato de dicts aceito por `start_chat(history=...)`."""
+    return [{"role": item["role"], "parts": item["parts"]} for item in wire]
+
+# Turnos serializados são comprimidos com zstd e marcados com um byte de versão, o que permite
+# trocar o formato no futuro. Itens sem marcação são msgpack puro (turnos curtos ou formato antigo).
+ZSTD_TAG = b"z1"
+ZSTD_MIN_SIZE = 256
+ZSTD_COMPRESSOR = zstd.ZstdCompressor(level=3)
+ZSTD_DECOMPRESSOR = zstd.ZstdDecompressor()
+
+@contextmanager
+def gc_paused():
+    """Pausa o GC geracional durante a (de)serialização, que cria muitos objetos pequenos de uma vez."""
+    was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if was_enabled:
+            gc.enable()
+
+def pack_turn(turn):
+    """Serializa um turno para o Redis, comprimindo-o quando compensa."""
+    blob = msgpack.packb(turn, use_bin_type=True)
+    if len(blob) < ZSTD_MIN_SIZE:
+        return blob
+    return ZSTD_TAG + ZSTD_COMPRESSOR.compress(blob)
+
+def unpack_turn(blob):
+    """Inverso de `pack_turn`."""
+    if blob.startswith(ZSTD_TAG):
+        blob = ZSTD_DECOMPRESSOR.decompress(blob[len(ZSTD_TAG):])
+    return msgpack.unpackb(blob, raw=False)
+
 app.mount("/images", StaticFiles(directory="images"), name="images")
 
 @app.get("/")
@@ -65,86 +307,187 @@ async def read_index(request: Request):
     return FileResponse('templates/index.html')
 
 
-@app.post("/chat")
-async def chat(request: ChatRequest):
+IMAGE_DRAFT_SIZE = (1024, 1024)
+# Orçamento de tamanho: recusa o payload antes de decodificar e a imagem antes de expandi-la em RAM.
+MAX_IMAGE_BASE64_LENGTH = 8 * 1024 * 1024
+MAX_IMAGE_BYTES = MAX_IMAGE_BASE64_LENGTH // 4 * 3
+MAX_IMAGE_PIXELS = 24_000_000
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+def strip_data_url_prefix(image_base64):
+    """Remove o prefixo opcional "data:image/...;base64," de uma Data URL."""
+    if image_base64.startswith("data:image/"):
+        return image_base64.partition(",")[2]
+    return image_base64
+
+def _decode_image(image_data):
+    # verify() checa a integridade só pelos cabeçalhos, mas inutiliza o objeto; reabre em seguida.
+    Image.open(io.BytesIO(image_data)).verify()
+    img = Image.open(io.BytesIO(image_data))
+    width, height = img.size
+    if width * height > MAX_IMAGE_PIXELS:
+        raise ValueError(f"Imagem com {width}x{height} pixels excede o limite de {MAX_IMAGE_PIXELS}.")
+    # Em JPEG, o libjpeg decodifica direto numa escala DCT reduzida; nos demais formatos é no-op.
+    img.draft("RGB", IMAGE_DRAFT_SIZE)
+    return img.convert("RGB")
+
+async def open_image(image_data):
+    """Abre os bytes recebidos como imagem PIL, respondendo 400 se forem inválidos."""
+    try:
+        # A decodificação é CPU-bound; roda numa thread para não travar o event loop.
+        return await asyncio.to_thread(_decode_image, image_data)
+    except Exception as e:
+        logging.error(f"Erro ao processar imagem: {e}")
+        raise HTTPException(status_code=400, detail="Formato de imagem inválido ou corrompido.")
+
+async def decode_base64_image(image_base64):
+    """Decodifica a imagem em base64, respondendo 400 se ela for inválida."""
+    try:
+        # pybase64 usa o decodificador SIMD da libbase64, bem mais rápido que o base64 da stdlib.
+        image_data = await asyncio.to_thread(pybase64.b64decode, image_base64, validate=False)
+    except Exception as e:
+        logging.error(f"Erro ao processar imagem em base64: {e}")
+        raise HTTPException(status_code=400, detail="Formato de imagem inválido ou corrompido.")
+    return await open_image(image_data)
+
+
+def check_chat_request(text, has_image, language):
+    """Validações feitas antes de qualquer decodificação de imagem."""
     if not model or not redis_client:
         detail_msg = "O serviço de IA ou o serviço de sessão (Redis) não estão disponíveis."
         logging.error(f"Tentativa de chamada ao chat, mas um serviço essencial não está inicializado. IA: {'OK' if model else 'FALHA'}, Redis: {'OK' if redis_client else 'FALHA'}")
         raise HTTPException(status_code=503, detail=detail_msg)
-    
-    if not request.text and not request.image_base64:
+
+    if not text and not has_image:
         raise HTTPException(status_code=400, detail="É necessário enviar texto ou imagem.")
 
+    if language is not None and language not in SUPPORTED_LANGUAGES:
+        raise HTTPException(status_code=400, detail="Idioma não suportado.")
+
+
+@app.post("/chat")
+async def chat(request: ChatRequest):
+    check_chat_request(request.text, bool(request.image_base64), request.language)
+    img = None
+    if request.image_base64:
+        image_base64 = strip_data_url_prefix(request.image_base64)
+        if len(image_base64) > MAX_IMAGE_BASE64_LENGTH:
+            raise HTTPException(status_code=413, detail="A imagem excede o tamanho máximo permitido.")
+        # Base64 com padding sempre tem comprimento múltiplo de 4: rejeita cedo o que está truncado.
+        if len(image_base64) & 3:
+            logging.error("Imagem em base64 com comprimento inválido.")
+            raise HTTPException(status_code=400, detail="Formato de imagem inválido ou corrompido.")
+        img = await decode_base64_image(image_base64)
+    return await process_chat(request.text, img, request.language, request.session_id)
+
+
+@app.post("/chat/upload")
+async def chat_upload(
+    file: UploadFile = File(...),
+    text: Optional[str] = Form(""),
+    language: Optional[str] = Form(None),
+    session_id: Optional[str] = Form(None),
+):
+    check_chat_request(text, True, language)
+    # multipart/form-data: os bytes chegam crus, sem o custo (e os 33% extras) do base64.
+    image_data = await file.read(MAX_IMAGE_BYTES + 1)
+    if len(image_data) > MAX_IMAGE_BYTES:
+        raise HTTPException(status_code=413, detail="A imagem excede o tamanho máximo permitido.")
+    img = await open_image(image_data)
+    return await process_chat(text, img, language, session_id)
+
+
+async def run_chat_turn(text, img, language, session_id):
+    history = [] # <--- ALTERAÇÃO: Começamos com um histórico vazio
+    convo = None
+
+    cached = chat_sessions.get(session_id) if LOCAL_SESSION_CACHE_ENABLED and session_id else None
+    if cached and language in (None, cached[0]):
+        # Sessão quente: reaproveita o ChatSession local e pula a leitura no Redis.
+        language, convo = cached
+        logging.info(f"Continuando sessão de chat em cache local: {session_id}")
+        # Sem a leitura, o TTL precisa ser renovado aqui (inclusive em turnos só com imagem).
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.expire(session_key(session_id), SESSION_EXPIRATION_SECONDS)
+            pipe.expire(session_language_key(session_id), SESSION_EXPIRATION_SECONDS)
+            await pipe.execute()
+    elif session_id:
+        # <--- ALTERAÇÃO: Tenta recuperar o histórico, não o objeto de chat.
+        serialized_turns, session_language = await session_reads.fetch(session_id)
+        if serialized_turns:
+            logging.info(f"Continuando sessão de chat existente: {session_id}")
+            with gc_paused():
+                history = wire_to_history([unpack_turn(turn) for turn in serialized_turns])
+            if not language and session_language:
+                session_language = session_language.decode()
+                if session_language in SUPPORTED_LANGUAGES:
+                    language = session_language
+
+    if convo is None and (not session_id or not history):
+        # Se não há sessão ou o histórico está vazio, inicia uma nova sessão.
+        session_id = str(uuid.uuid4())
+        history = []
+        logging.info(f"Iniciando nova sessão de chat: {session_id}")
+
+    language = language or DEFAULT_LANGUAGE
+    session_model = get_model(language)
+
+    if convo is None:
+        # <--- ALTERAÇÃO: Cria o objeto de chat a partir do histórico recuperado do Redis.
+        convo = session_model.start_chat(history=history)
+
+    logging.info(f"Recebida requisição para a sessão {session_id}. Imagem anexada: {'Sim' if img is not None else 'Não'}")
+
+    response_text = ""
+    response_from_api = None
+
+    if img is not None:
+        prompt_parts = [img, text or "Descreva esta imagem."]
+
+        logging.info(f"Enviando prompt com imagem (stateless) para a sessão {session_id}.")
+        response_from_api = await session_model.generate_content_async(prompt_parts)
+        response_text = response_from_api.text
+
+    elif text:
+        logging.info(f"Enviando prompt de texto (stateful) para a sessão {session_id}.")
+        previous_length = len(convo.history)
+        response_from_api = await convo.send_message_async(text)
+        response_text = response_from_api.text
+        # Limita o histórico à janela mais recente, na memória e no Redis (LTRIM abaixo).
+        new_turns = convo.history[previous_length:]
+        convo.history = convo.history[-MAX_HISTORY_MESSAGES:]
+        if LOCAL_SESSION_CACHE_ENABLED:
+            chat_sessions[session_id] = (language, convo)
+
+        # --- ALTERAÇÃO: Anexa apenas os turnos novos, em vez de regravar o histórico inteiro.
+        if new_turns:
+            with gc_paused():
+                serialized_new_turns = [pack_turn(turn) for turn in history_to_wire(new_turns)]
+            async with redis_client.pipeline(transaction=False) as pipe:
+                pipe.rpush(session_key(session_id), *serialized_new_turns)
+                pipe.ltrim(session_key(session_id), -MAX_HISTORY_MESSAGES, -1)
+                pipe.expire(session_key(session_id), SESSION_EXPIRATION_SECONDS)
+                pipe.set(session_language_key(session_id), language, ex=SESSION_EXPIRATION_SECONDS)
+                await pipe.execute()
+            logging.info(f"Histórico da sessão {session_id} atualizado no Redis (+{len(new_turns)} turnos).")
+
+    if not response_text:
+        feedback = getattr(response_from_api, 'prompt_feedback', 'N/A')
+        logging.warning(f"Resposta da API para a sessão {session_id} está vazia. Detalhes: {feedback}")
+        raise HTTPException(status_code=500, detail="A API não retornou uma resposta de texto válida.")
+
+    logging.info(f"Resposta enviada com sucesso para a sessão {session_id}.")
+    return {"response": response_text, "session_id": session_id}
+
+
+async def process_chat(text, img, language, session_id):
+    session_id = parse_session_id(session_id)
     try:
-        session_id = request.session_id
-        history = [] # <--- ALTERAÇÃO: Começamos com um histórico vazio
-        SESSION_EXPIRATION_SECONDS = 1800 # 30 minutos
-
-        if session_id:
-            # <--- ALTERAÇÃO: Tenta recuperar o histórico, não o objeto de chat.
-            serialized_history = redis_client.get(session_id)
-            if serialized_history:
-                logging.info(f"Continuando sessão de chat existente: {session_id}")
-                history = pickle.loads(serialized_history)
-                redis_client.expire(session_id, SESSION_EXPIRATION_SECONDS)
-        
-        if not session_id or not history:
-            # Se não há sessão ou o histórico está vazio, inicia uma nova sessão.
-            session_id = str(uuid.uuid4())
-            history = []
-            logging.info(f"Iniciando nova sessão de chat: {session_id}")
-
-        # <--- ALTERAÇÃO: Cria um novo objeto de chat em cada requisição, usando o histórico recuperado.
-        convo = model.start_chat(history=history)
-
-        logging.info(f"Recebida requisição para a sessão {session_id}. Imagem anexada: {'Sim' if request.image_base64 else 'Não'}")
-        
-        response_text = ""
-        response_from_api = None
-
-        if request.image_base64:
-            prompt_parts = []
-            try:
-                image_data = base64.b64decode(request.image_base64)
-                img = Image.open(io.BytesIO(image_data))
-                prompt_parts.append(img)
-            except Exception as e:
-                logging.error(f"Erro ao processar imagem em base64: {e}")
-                raise HTTPException(status_code=400, detail="Formato de imagem inválido ou corrompido.")
-
-            prompt_parts.append(f"Responda em {request.language}. {request.text or 'Descreva esta imagem.'}")
-            
-            logging.info(f"Enviando prompt com imagem (stateless) para a sessão {session_id}.")
-            response_from_api = model.generate_content(prompt_parts)
-            response_text = response_from_api.text
-        
-        elif request.text:
-            prompt_with_lang = f"Responda em {request.language}. {request.text}"
-            logging.info(f"Enviando prompt de texto (stateful) para a sessão {session_id}.")
-            response_from_api = convo.send_message(prompt_with_lang)
-            response_text = response_from_api.text
-
-            # --- ALTERAÇÃO: Salva o histórico atualizado, não o objeto de chat.
-            updated_history = convo.history
-            serialized_history_updated = pickle.dumps(updated_history)
-            redis_client.set(session_id, serialized_history_updated, ex=SESSION_EXPIRATION_SECONDS)
-            logging.info(f"Histórico da sessão {session_id} salvo/atualizado no Redis.")
-
-        if not response_text:
-            feedback = getattr(response_from_api, 'prompt_feedback', 'N/A')
-            logging.warning(f"Resposta da API para a sessão {session_id} está vazia. Detalhes: {feedback}")
-            raise HTTPException(status_code=500, detail="A API não retornou uma resposta de texto válida.")
-
-        logging.info(f"Resposta enviada com sucesso para a sessão {session_id}.")
-        return {"response": response_text, "session_id": session_id}
-
-    except redis.exceptions.RedisError as e:
+        async with session_lock(session_id):
+            return await run_chat_turn(text, img, language, session_id)
+    except aioredis.RedisError as e:
         logging.critical(f"Erro de comunicação com o Redis: {e}", exc_info=True)
         raise HTTPException(status_code=503, detail="Não foi possível conectar ao serviço de sessão.")
     except Exception as e:
-        # Apanha o erro de pickle aqui também, por segurança.
-        if "pickle" in str(e).lower():
-             logging.critical(f"Erro de serialização (pickle): {e}", exc_info=True)
-             raise HTTPException(status_code=500, detail="Ocorreu um erro ao tentar salvar o estado da conversa.")
         logging.critical(f"Erro inesperado no endpoint /chat: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="Ocorreu um erro interno inesperado no servidor.")